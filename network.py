@@ -2,20 +2,39 @@
 
 # TODO
 # pre-extract np stuff (?)
-# use in-place arithmetic when possible
 # take care with rng seeding, etc.
-# compare sparse array to regular numpy array
 # figure out how to vectorize the recurrent training step (no for loop over plastic units)
 # build lightweight, optional trial "logging" for visualizing e.g. training
 
 import matplotlib.pyplot as plt
 import numpy as np
-# from scipy.sparse import csr_matrix
-from scipy.stats import norm
+from numba import get_num_threads, njit, prange
+from scipy.sparse import csr_matrix, issparse
+from scipy.sparse import random as sparse_random
+from scipy.sparse._sparsetools import csr_matvec, csr_matvecs
+from scipy.sparse.linalg import aslinearoperator
 from tqdm import tqdm
 
 prng_seed = 1234
-prng = np.random.RandomState(prng_seed)
+prng = np.random.default_rng(prng_seed)  # PCG64
+
+# weights, activity and noise are single precision, which halves the memory traffic
+# of the recurrent products. RLS P matrices remain double precision for stability
+float_type = np.float32
+
+# wxx is kept as a dense array when a dense matvec is cheaper than a CSR one.
+# measured in float32 on one core for 800-3200 units, a CSR nonzero costs about as much
+# as dense_nnz_cost dense entries, so dense wins from ~25% connectivity, where it also
+# takes at most twice the memory of CSR. small networks are dominated by call overhead.
+# this only affects the loops that multiply through the wxx operator: the parallel
+# test kernel converts a dense wxx to CSR on each call
+dense_nnz_cost = 4
+dense_max_n_units = 400
+
+# test trials run in a parallel tanh kernel, one trial per thread, only when at least
+# this many threads are available. on one core its per-trial CSR matvecs took ~3.3x as
+# long as the batched matmat path, which loads each weight once per step for all trials
+test_kernel_min_threads = 4
 
 
 class Generator(object):
@@ -57,27 +76,40 @@ class Trial(object):
         self.time_ms = np.arange(0, self.max_ms, self.time_step)
 
         # plotting
-        self.plot_skip = np.ceil(self.n_steps / self.plot_points)
+        self.plot_skip = -(-self.n_steps // self.plot_points)  # integer ceil
         if self.plot_skip % 2 == 0:
             self.plot_skip += 1
 
 
 class Input(object):
-    """ an input to a network """
+    """ an input to a network: a pulse of value into its first unit """
 
     def __init__(self, trial_obj, n_units, value, start_ms, duration_ms):
         self.n_units = n_units
         self.value = value
         self.start_ms = start_ms
         self.duration_ms = duration_ms
+        self.n_steps = trial_obj.n_steps
 
-        # making input time series
+        # only the time steps of the pulse are kept, not a dense time series
         startpulse_idx = int(np.round(start_ms / trial_obj.time_step))
         pulsedur_samps = int(np.round(duration_ms / trial_obj.time_step))
+        self.pulse_slice = slice(startpulse_idx, startpulse_idx + pulsedur_samps - 1)
 
-        input_series = np.zeros((n_units, trial_obj.n_steps))
-        input_series[0, startpulse_idx:startpulse_idx + pulsedur_samps - 1] = value
-        self.series = input_series
+    @property
+    def series(self):
+        """ the input time series, (n_units, n_steps), built on demand (e.g. for plotting).
+            the simulations use drive instead """
+        input_series = np.zeros((self.n_units, self.n_steps), dtype=float_type)
+        input_series[0, self.pulse_slice] = self.value
+        return input_series
+
+    def drive(self, winputx):
+        """ the drive of this input onto each recurrent unit at each step, i.e.
+            series.T @ winputx.T, built from the pulse window alone """
+        input_drive = np.zeros((self.n_steps, winputx.shape[0]), dtype=float_type)
+        input_drive[self.pulse_slice] = self.value * winputx[:, 0]
+        return input_drive
 
 
 class Output(object):
@@ -91,8 +123,8 @@ class Output(object):
         self.baseline_val = baseline_val
 
         # making output time series
-        bell = norm.pdf(trial_obj.time_ms, center_ms, width_ms).reshape(1, -1)
-        bell /= np.max(bell)  # by the way, this is a fast way to normalize a vector to 1
+        # unnormalized gaussian, so that it peaks at 1 at center_ms
+        bell = np.exp(-0.5 * ((trial_obj.time_ms - center_ms) / width_ms) ** 2).reshape(1, -1)
         self.series = bell * (value - baseline_val) + baseline_val
 
 
@@ -101,7 +133,8 @@ class Trainer(object):
         consumes network, input, output, and trial objects.
         defines some parameters relevant to training.
         simulates a neural network and trains its weights.
-        stages are innate, recurrent, readout, and test """
+        stages are innate, recurrent, readout, and test.
+        sigmoid is an elementwise function taking an out argument, e.g. np.tanh """
 
     def __init__(self, generator_obj, input_obj, output_obj, trial_obj,
                  tau_ms, sigmoid, noise_harvest, noise_train,
@@ -126,56 +159,101 @@ class Trainer(object):
         # constant for dividing change in firing rate
         self.time_div = tau_ms / self.tr.time_step
 
+        # noise buffers, by shape, reused across calls
+        self._noise_bufs = {}
+
+        # linear operators on recurrent weight matrices, by id of the matrix
+        self._wxx_ops = {}
+
+    def _make_noise(self, noise_amp, shape):
+        """ fill a reusable buffer of the given shape with gaussian noise,
+            scaled by noise_amp and the square root of the time step """
+
+        noise_buf = self._noise_bufs.get(shape)
+        if noise_buf is None:
+            noise_buf = self._noise_bufs[shape] = np.empty(shape, dtype=float_type)
+
+        prng.standard_normal(dtype=float_type, out=noise_buf)
+        noise_buf *= noise_amp * np.sqrt(self.tr.time_step)
+        return noise_buf
+
+    def _wxx_operator(self, wxx):
+        """ the linear operator that the simulation loops multiply wxx through,
+            built once per weight matrix. training updates wxx in-place,
+            which the operator sees """
+
+        wxx_cached, wxx_op = self._wxx_ops.get(id(wxx), (None, None))
+        if wxx_cached is not wxx:  # ids can be reused once a matrix is freed
+            wxx_op = _csr_operator(wxx) if issparse(wxx) else _dense_operator(wxx)
+            self._wxx_ops[id(wxx)] = (wxx, wxx_op)
+        return wxx_op
+
     def initialize_weights(self):
         """ initialize synaptic weights, including input-to-recurrent,
             recurrent-to-recurrent, and recurrent-to-output """
 
-        # generator recurrent weights (wxx)
-        wxx_mask = prng.rand(self.gen.n_units, self.gen.n_units)  # uniform distribution!
-        wxx_mask[wxx_mask <= self.gen.p_connect] = 1
-        wxx_mask[wxx_mask < 1] = 0
-        wxx_vals = prng.normal(scale=self.gen.scale_recurr,
-                               size=(self.gen.n_units, self.gen.n_units))
-        wxx_nonsparse = wxx_vals * wxx_mask
-        np.fill_diagonal(wxx_nonsparse, 0)
-        # self.gen.wxx_ini = csr_matrix(wxx_nonsparse)
-        self.gen.wxx_ini = wxx_nonsparse
+        # generator recurrent weights (wxx), drawn directly in sparse form with no self-connections
+        wxx = sparse_random(self.gen.n_units, self.gen.n_units, density=self.gen.p_connect,
+                            format='csr', dtype=float_type, rng=prng,
+                            data_rvs=lambda k: prng.normal(scale=self.gen.scale_recurr, size=k))
+        wxx.setdiag(0)
+        wxx.eliminate_zeros()
+
+        if (wxx.nnz * dense_nnz_cost >= self.gen.n_units ** 2
+                or self.gen.n_units <= dense_max_n_units):
+            wxx = wxx.toarray()
+        self.gen.wxx_ini = wxx
 
         # input => RRN (winputx)
-        self.inp.winputx_ini = prng.normal(scale=1,
-                                           size=(self.gen.n_units, self.inp.n_units))
+        self.inp.winputx_ini = prng.standard_normal((self.gen.n_units, self.inp.n_units),
+                                                    dtype=float_type)
 
         # RRN => output (wxout)
-        self.out.wxout_ini = prng.normal(scale=1 / np.sqrt(self.gen.n_units),
-                                         size=(self.out.n_units, self.gen.n_units))
+        self.out.wxout_ini = prng.standard_normal((self.out.n_units, self.gen.n_units),
+                                                  dtype=float_type)
+        self.out.wxout_ini /= np.sqrt(self.gen.n_units)
 
     def harvest_innate(self):
         """ present the input to the RRN and save its trajectory. """
 
         print('harvesting innate trajectory')
 
-        # assigning recurrent and input weights to workspace names
-        wxx = self.gen.wxx_ini
-        winputx = self.inp.winputx_ini
+        # assigning recurrent weights and input drive to workspace names.
+        # the drive from the input is computed for all steps at once
+        input_drive = self.inp.drive(self.inp.winputx_ini)
+        wxx_op = self._wxx_operator(self.gen.wxx_ini)
 
-        # creating all noise ahead of time
-        all_noise = self.noise_harvest * prng.normal(scale=np.sqrt(self.tr.time_step),
-                                                     size=(self.gen.n_units, self.tr.n_steps))
+        # creating all noise ahead of time, time-major so that each step reads one row
+        all_noise = self._make_noise(self.noise_harvest, (self.tr.n_steps, self.gen.n_units))
 
-        # what we are really interested in: the innate trajectory
-        x_history = np.empty((self.gen.n_units, self.tr.n_steps))
+        # what we are really interested in: the innate trajectory.
+        # stored time-major so that each step writes one contiguous row
+        x_history = np.empty((self.tr.n_steps, self.gen.n_units), dtype=float_type)
 
         # creating initial conditions for firing rate & activation level
-        x_lvl = 2 * prng.rand(self.gen.n_units) - 1
-        x_fr = self.sigmoid(x_lvl)
-
+        x_lvl = 2 * prng.random(self.gen.n_units, dtype=float_type) - 1
+
+        # a single trajectory gains nothing from a compiled loop: scipy's CSR matvec and
+        # numpy's vectorized tanh already beat a scalar numba kernel of the same step
+        sigmoid = self.sigmoid
+        wxx_matvec = wxx_op.matvec
+        x_fr = sigmoid(x_lvl)
+        # a dtype mismatch with wxx would make every product upcast and copy
+        assert x_fr.dtype == wxx_op.dtype, 'sigmoid must preserve the dtype of its input'
         for t in range(self.tr.n_steps):
-            x_lvl_update = wxx @ x_fr + winputx @ self.inp.series[:, t] + all_noise[:, t]
-            x_lvl += (-x_lvl + x_lvl_update) / self.time_div
-            x_fr = self.sigmoid(x_lvl)
-            x_history[:, t] = x_fr
-
-        self.gen.innate = x_history  # save the innate trajectory
+            # the operator reuses its output buffer, so the update is built in it
+            x_lvl_update = wxx_matvec(x_fr)
+            x_lvl_update += input_drive[t]
+            x_lvl_update += all_noise[t]
+            # in-place form of x_lvl += (-x_lvl + x_lvl_update) / time_div
+            x_lvl_update -= x_lvl
+            x_lvl_update /= self.time_div
+            x_lvl += x_lvl_update
+            # the firing rate is computed straight into its history row
+            x_fr = x_history[t]
+            sigmoid(x_lvl, out=x_fr)
+
+        self.gen.innate = x_history.T  # save the innate trajectory, (n_units, n_steps)
 
     def train_recurrent(self):
         """ train the recurrent weights using a previously harvested innate trajectory
@@ -183,55 +261,88 @@ class Trainer(object):
 
         print('training recurrent weights with innate target')
 
-        # assigning recurrent and input weights to workspace names
+        # assigning recurrent and input weights to workspace names.
+        # the innate target is read time-major, one row per step
         wxx = self.gen.wxx_ini
-        winputx = self.inp.winputx_ini
+        innate = self.gen.innate.T
+        input_drive = self.inp.drive(self.inp.winputx_ini)
         wxout = self.out.wxout_ini
+        wxx_op = self._wxx_operator(wxx)
+        wxx_matvec = wxx_op.matvec
+
+        # the plastic weights are updated in-place through a flat view of wxx:
+        # its data array if sparse, or its raveled array if dense.
+        # plastic_nz indexes the flat view at each plastic weight, in row-major order
+        n_plastic = self.gen.n_plastic
+        if issparse(wxx):
+            wxx_flat = wxx.data
+            plastic_nz = slice(0, wxx.indptr[n_plastic])
+            plastic_cols = wxx.indices[plastic_nz]
+            plastic_bounds = wxx.indptr[:n_plastic + 1]
+        else:
+            wxx_flat = wxx.ravel()
+            plastic_rows, plastic_cols = np.nonzero(wxx[:n_plastic])
+            plastic_nz = plastic_rows * self.gen.n_units + plastic_cols
+            plastic_bounds = np.searchsorted(plastic_rows, np.arange(n_plastic + 1))
+        plastic_rows = np.repeat(np.arange(n_plastic), np.diff(plastic_bounds))
 
         # initializing the P matrix
         delta = 1
-        pre_plastic_inds = np.empty(self.gen.n_plastic, dtype=object)
-        p_recurr = np.empty(self.gen.n_plastic, dtype=object)
-        row_inds, col_inds = wxx.nonzero()
-        for p_unit in range(self.gen.n_plastic):
-            tmp_inds = col_inds[np.where(row_inds == p_unit)[0]]
-            pre_plastic_inds[p_unit] = tmp_inds
-            p_recurr[p_unit] = np.eye(tmp_inds.size) / delta
+        pre_plastic_inds = np.empty(n_plastic, dtype=object)
+        pre_plastic_nz = np.empty(n_plastic, dtype=object)
+        p_recurr = np.empty(n_plastic, dtype=object)
+        for p_unit in range(n_plastic):
+            unit_slice = slice(plastic_bounds[p_unit], plastic_bounds[p_unit + 1])
+            pre_plastic_inds[p_unit] = plastic_cols[unit_slice]
+            pre_plastic_nz[p_unit] = (unit_slice if issparse(wxx)
+                                      else plastic_nz[unit_slice])
+            p_recurr[p_unit] = np.eye(pre_plastic_inds[p_unit].size) / delta
 
         # creating all noise ahead of time
-        all_noise = self.noise_train * prng.normal(scale=np.sqrt(self.tr.time_step),
-                                                   size=(
-                                                       self.gen.n_units, self.n_trials_recurrent,
-                                                       self.tr.n_steps))
+        # trials run one after another, so each (trial, step) reads one contiguous row
+        all_noise = self._make_noise(self.noise_train, (self.n_trials_recurrent, self.tr.n_steps,
+                                                        self.gen.n_units))
 
         # creating all initial condition for firing rate & activation level ahead of time
-        x_lvl_init = 2 * prng.rand(self.gen.n_units, self.n_trials_recurrent) - 1
-        x_fr_init = self.sigmoid(x_lvl_init)
-
-        # initializing history vars
-        x_history = np.empty((self.n_trials_recurrent, self.gen.n_units, self.tr.n_steps))
-        out_history = np.empty((self.n_trials_recurrent, self.out.n_units, self.tr.n_steps))
+        # trials run one after another, so each trial's state is one contiguous row
+        x_lvl_init = 2 * prng.random((self.n_trials_recurrent, self.gen.n_units), dtype=float_type) - 1
+        sigmoid = self.sigmoid
+        x_fr_init = sigmoid(x_lvl_init)
+        # a dtype mismatch with wxx would make every product upcast and copy
+        assert x_fr_init.dtype == wxx_op.dtype, 'sigmoid must preserve the dtype of its input'
+
+        # initializing history vars, time-major within each trial so that each step
+        # (or training step) writes one contiguous block
+        x_history = np.empty((self.n_trials_recurrent, self.tr.n_steps, self.gen.n_units),
+                             dtype=float_type)
+        out_history = np.empty((self.n_trials_recurrent, self.tr.n_steps, self.out.n_units),
+                               dtype=float_type)
         wxx_history = np.empty((self.n_trials_recurrent,
-                                self.gen.n_plastic, self.tr.n_training_steps),)
-                               # dtype=np.dtype('float16'))
+                                self.tr.n_training_steps, self.gen.n_plastic),
+                               dtype=float_type)
 
         # trials are non-parallel
         do_train = False
         for trial in range(self.n_trials_recurrent):
 
-            x_lvl = x_lvl_init[:, trial]
-            x_fr = x_fr_init[:, trial]
+            x_lvl = x_lvl_init[trial]
+            x_fr = x_fr_init[trial]
 
             # time steps are non-parallel
             train_dum = 0
             for t in tqdm(range(self.tr.n_steps)):
-                x_lvl_update = wxx @ x_fr + winputx @ self.inp.series[:, t] + all_noise[:, trial, t]
-                x_lvl += (-x_lvl + x_lvl_update) / self.time_div
-                x_fr = self.sigmoid(x_lvl)
-                out = wxout @ x_fr
-
-                x_history[trial, :, t] = x_fr
-                out_history[trial, :, t] = out
+                x_lvl_update = wxx_matvec(x_fr)
+                x_lvl_update += input_drive[t]
+                x_lvl_update += all_noise[trial, t]
+                # in-place form of x_lvl += (-x_lvl + x_lvl_update) / time_div
+                x_lvl_update -= x_lvl
+                x_lvl_update /= self.time_div
+                x_lvl += x_lvl_update
+                # firing rate and output are computed straight into their history rows
+                x_fr = x_history[trial, t]
+                sigmoid(x_lvl, out=x_fr)
+                out = out_history[trial, t]
+                np.dot(wxout, x_fr, out=out)
 
                 if t == self.tr.start_train_n:
                     do_train = True
@@ -240,7 +351,7 @@ class Trainer(object):
 
                 if do_train and t % self.tr.spacing == 0:
 
-                    error = x_fr - self.gen.innate[:, t]
+                    error = x_fr - innate[t]
 
                     for p_unit in range(self.gen.n_plastic):
                         x_pre = x_fr[pre_plastic_inds[p_unit]]
@@ -249,14 +360,17 @@ class Trainer(object):
                         den_recurr = 1 + x_pre @ p_old_x
                         p_recurr[p_unit] = p_old - (np.outer(p_old_x, p_old_x) / den_recurr)
                         dw = -error[p_unit] * p_old_x / den_recurr
-                        wxx[p_unit, pre_plastic_inds[p_unit]] += dw
+                        wxx_flat[pre_plastic_nz[p_unit]] += dw
 
-                    wxx_history[trial, :, train_dum] = np.sum(np.fabs(wxx[:self.gen.n_plastic, :]), 1)
+                    wxx_history[trial, train_dum] = np.bincount(
+                        plastic_rows, np.fabs(wxx_flat[plastic_nz]), n_plastic)
                     train_dum += 1
 
         self.gen.wxx_recurr_trained = wxx
 
-        return x_history, out_history, wxx_history
+        # histories are returned as (n_trials, n_units, n_steps) views
+        return (x_history.transpose(0, 2, 1), out_history.transpose(0, 2, 1),
+                wxx_history.transpose(0, 2, 1))
 
     def train_readout(self):
         """ train the readout weights using a pre-defined output as the target.
@@ -266,8 +380,13 @@ class Trainer(object):
 
         # assigning recurrent and input weights to workspace names
         wxx = self.gen.wxx_recurr_trained
-        winputx = self.inp.winputx_ini
+        input_drive = self.inp.drive(self.inp.winputx_ini)
         wxout = self.out.wxout_ini
+        wxx_op = self._wxx_operator(wxx)
+        wxx_matvec = wxx_op.matvec
+
+        # the output target is read time-major, one row per step
+        out_target = self.out.series.T
 
         # initializing the P matrix
         delta = 1
@@ -275,27 +394,34 @@ class Trainer(object):
 
         # creating all noise ahead of time
         # separate noise for each neuron, trial, and time-step
-        all_noise = self.noise_train * prng.normal(scale=np.sqrt(self.tr.time_step),
-                                                   size=(
-                                                       self.gen.n_units, self.n_trials_readout,
-                                                       self.tr.n_steps))
+        # trials run one after another, so each (trial, step) reads one contiguous row
+        all_noise = self._make_noise(self.noise_train, (self.n_trials_readout, self.tr.n_steps,
+                                                        self.gen.n_units))
 
         # creating all initial condition for firing rate & activation level ahead of time,
         # potentially separately for each trial
-        x_lvl_init = 2 * prng.rand(self.gen.n_units, self.n_trials_readout) - 1
-        x_fr_init = self.sigmoid(x_lvl_init)
-
-        x_history = np.empty((self.n_trials_readout, self.gen.n_units, self.tr.n_steps))
-
-        out_history = np.empty((self.n_trials_readout, self.out.n_units, self.tr.n_steps))
+        # trials run one after another, so each trial's state is one contiguous row
+        x_lvl_init = 2 * prng.random((self.n_trials_readout, self.gen.n_units), dtype=float_type) - 1
+        sigmoid = self.sigmoid
+        x_fr_init = sigmoid(x_lvl_init)
+        # a dtype mismatch with wxx would make every product upcast and copy
+        assert x_fr_init.dtype == wxx_op.dtype, 'sigmoid must preserve the dtype of its input'
+
+        x_history = np.empty((self.n_trials_readout, self.tr.n_steps, self.gen.n_units),
+                             dtype=float_type)
+
+        out_history = np.empty((self.n_trials_readout, self.tr.n_steps, self.out.n_units),
+                               dtype=float_type)
         # error_history = np.zeros((self.n_trials_readout, self.out.n_units, self.tr.n_steps))
 
         # p_history = np.zeros((self.n_trials_readout, self.out.n_units, self.out.n_units, self.tr.n_steps))
-        wxout_history = np.zeros((self.n_trials_readout, self.out.n_units, self.gen.n_units, self.tr.n_training_steps))
+        wxout_history = np.zeros((self.n_trials_readout, self.tr.n_training_steps,
+                                  self.out.n_units, self.gen.n_units),
+                                 dtype=float_type)
 
         # set initial activity and firing rate to be for first trial
-        x_lvl = x_lvl_init[:, 0]
-        x_fr = x_fr_init[:, 0]
+        x_lvl = x_lvl_init[0]
+        x_fr = x_fr_init[0]
 
         # trials are non-parallel
         do_train = False
@@ -303,19 +429,24 @@ class Trainer(object):
         for trial in range(self.n_trials_readout):
 
             if discontinuous_trials:
-                x_lvl = x_lvl_init[:, trial]
-                x_fr = x_fr_init[:, trial]
+                x_lvl = x_lvl_init[trial]
+                x_fr = x_fr_init[trial]
 
             # time steps are non-parallel
             train_dum = 0
             for t in tqdm(range(self.tr.n_steps)):
-                x_lvl_update = wxx @ x_fr + winputx @ self.inp.series[:, t] + all_noise[:, trial, t]
-                x_lvl += (-x_lvl + x_lvl_update) / self.time_div
-                x_fr = self.sigmoid(x_lvl)
-                out = wxout @ x_fr
-
-                x_history[trial, :, t] = x_fr
-                out_history[trial, :, t] = out
+                x_lvl_update = wxx_matvec(x_fr)
+                x_lvl_update += input_drive[t]
+                x_lvl_update += all_noise[trial, t]
+                # in-place form of x_lvl += (-x_lvl + x_lvl_update) / time_div
+                x_lvl_update -= x_lvl
+                x_lvl_update /= self.time_div
+                x_lvl += x_lvl_update
+                # firing rate and output are computed straight into their history rows
+                x_fr = x_history[trial, t]
+                sigmoid(x_lvl, out=x_fr)
+                out = out_history[trial, t]
+                np.dot(wxout, x_fr, out=out)
 
                 if t == self.tr.start_train_n:
                     do_train = True
@@ -323,7 +454,7 @@ class Trainer(object):
                     do_train = False
 
                 if do_train and t % self.tr.spacing == 0:
-                    error = out - self.out.series[:, t]
+                    error = out - out_target[t]
                     # error_history[trial, :, t] = error
 
                     p_old_x = p_readout @ x_fr
@@ -335,12 +466,14 @@ class Trainer(object):
                     # update output weights
                     dw = -error * p_old_x / den_readout
                     wxout += dw
-                    wxout_history[trial, :, :, train_dum] = wxout
+                    wxout_history[trial, train_dum] = wxout
                     train_dum += 1
 
         self.out.wxout_readout_trained = wxout
 
-        return x_history, out_history, wxout_history
+        # histories are returned as (n_trials, n_units, n_steps) views
+        return (x_history.transpose(0, 2, 1), out_history.transpose(0, 2, 1),
+                wxout_history.transpose(0, 2, 3, 1))
 
     def test(self):
         """ test the network by presenting the input and recording the output """
@@ -349,44 +482,169 @@ class Trainer(object):
 
         # assigning recurrent and input weights to workspace names
         wxx = self.gen.wxx_recurr_trained
-        winputx = self.inp.winputx_ini
+        input_drive = self.inp.drive(self.inp.winputx_ini)
         wxout = self.out.wxout_readout_trained
 
+        # no weights change during testing, so the trials are independent.
+        # they are simulated together: state is (n_units, n_trials) and wxx multiplies
+        # all of it. with tanh and enough threads they instead run in parallel in a
+        # compiled kernel, one trial per thread. arrays are laid out for contiguous
+        # access in each case
+        n_threads = min(get_num_threads(), self.n_trials_test)
+        use_kernel = self.sigmoid is np.tanh and n_threads >= test_kernel_min_threads
+        if use_kernel:
+            noise_shape = (self.n_trials_test, self.tr.n_steps, self.gen.n_units)
+            x_history_shape = (self.n_trials_test, self.tr.n_steps, self.gen.n_units)
+            out_history_shape = (self.n_trials_test, self.tr.n_steps, self.out.n_units)
+        else:
+            noise_shape = (self.tr.n_steps, self.gen.n_units, self.n_trials_test)
+            x_history_shape = (self.tr.n_steps, self.gen.n_units, self.n_trials_test)
+            out_history_shape = (self.tr.n_steps, self.out.n_units, self.n_trials_test)
+
         # creating all noise ahead of time
-        all_noise = self.noise_train * prng.normal(scale=np.sqrt(self.tr.time_step),
-                                                   size=(
-                                                       self.gen.n_units, self.n_trials_test,
-                                                       self.tr.n_steps))
+        all_noise = self._make_noise(self.noise_train, noise_shape)
 
         # creating all initial condition for firing rate & activation level ahead of time
-        x_lvl_init = 2 * prng.rand(self.gen.n_units, self.n_trials_test) - 1
-        x_fr_init = self.sigmoid(x_lvl_init)
-
-        x_history = np.empty((self.gen.n_units, self.tr.n_steps))
-        out_history = np.empty((self.out.n_units, self.tr.n_steps))
-
-        f_lst = []
-        for trial in range(self.n_trials_test):
-
-            x_lvl = x_lvl_init[:, trial]
-            x_fr = x_fr_init[:, trial]
+        x_lvl_init = 2 * prng.random((self.gen.n_units, self.n_trials_test), dtype=float_type) - 1
+
+        x_history = np.empty(x_history_shape, dtype=float_type)
+        out_history = np.empty(out_history_shape, dtype=float_type)
+
+        if use_kernel:
+            wxx_csr = wxx if issparse(wxx) else csr_matrix(wxx)
+            _test_kernel(wxx_csr.data, wxx_csr.indices, wxx_csr.indptr, wxout, input_drive,
+                         all_noise, x_lvl_init, self.time_div, x_history, out_history)
+            x_trials = x_history.transpose(0, 2, 1)
+            out_trials = out_history.transpose(0, 2, 1)
+        else:
+            sigmoid = self.sigmoid
+            wxx_op = self._wxx_operator(wxx)
+            wxx_matmat = wxx_op.matmat
+            x_lvl = x_lvl_init
+            x_fr = sigmoid(x_lvl_init)
+            # a dtype mismatch with wxx would make every product upcast and copy
+            assert x_fr.dtype == wxx_op.dtype, 'sigmoid must preserve the dtype of its input'
 
             # time steps are non-parallel
             for t in tqdm(range(self.tr.n_steps)):
-                x_lvl_update = wxx @ x_fr + winputx @ self.inp.series[:, t] + all_noise[:, trial, t]
-                x_lvl += (-x_lvl + x_lvl_update) / self.time_div
-                x_fr = self.sigmoid(x_lvl)
-                out = wxout @ x_fr
-
-                x_history[:, t] = x_fr
-                out_history[:, t] = out
+                x_lvl_update = wxx_matmat(x_fr)
+                x_lvl_update += input_drive[t, :, None]
+                x_lvl_update += all_noise[t]
+                x_lvl_update -= x_lvl
+                x_lvl_update /= self.time_div
+                x_lvl += x_lvl_update
+                # firing rates and outputs are computed straight into their history rows
+                x_fr = x_history[t]
+                sigmoid(x_lvl, out=x_fr)
+                np.dot(wxout, x_fr, out=out_history[t])
+
+            x_trials = x_history.transpose(2, 1, 0)
+            out_trials = out_history.transpose(2, 1, 0)
 
-            f = plot_trial(self, x_history, out_history)
+        f_lst = []
+        for trial in range(self.n_trials_test):
+            f = plot_trial(self, x_trials[trial], out_trials[trial])
             f_lst.append(f)
 
         return f_lst
 
 
+def _csr_operator(wxx):
+    """ wrap a CSR matrix as a LinearOperator whose matvec / matmat call scipy's CSR
+        kernels directly on its arrays, skipping the scipy.sparse dispatch.
+        products are written into reused buffers, so each one must be consumed
+        before the next. in-place changes to wxx.data are seen by the operator """
+
+    n_rows, n_cols = wxx.shape
+    data, indices, indptr = wxx.data, wxx.indices, wxx.indptr
+    matvec_out = np.empty(n_rows, dtype=wxx.dtype)
+    matmat_outs = {}
+
+    def matvec(x):
+        matvec_out.fill(0)  # the kernels accumulate into their output
+        csr_matvec(n_rows, n_cols, indptr, indices, data, x.ravel(), matvec_out)
+        return matvec_out
+
+    def matmat(x):
+        n_vecs = x.shape[1]
+        matmat_out = matmat_outs.get(n_vecs)
+        if matmat_out is None:
+            matmat_out = matmat_outs[n_vecs] = np.empty((n_rows, n_vecs), dtype=wxx.dtype)
+        matmat_out.fill(0)
+        csr_matvecs(n_rows, n_cols, n_vecs, indptr, indices, data, x, matmat_out)
+        return matmat_out
+
+    wxx_op = aslinearoperator(wxx)
+    wxx_op._matvec = matvec
+    wxx_op._matmat = matmat
+    return wxx_op
+
+
+def _dense_operator(wxx):
+    """ wrap a dense matrix as a LinearOperator whose matvec / matmat are BLAS products
+        written into reused buffers, like those of _csr_operator """
+
+    n_rows = wxx.shape[0]
+    matvec_out = np.empty(n_rows, dtype=wxx.dtype)
+    matmat_outs = {}
+
+    def matvec(x):
+        return np.dot(wxx, x.ravel(), out=matvec_out)
+
+    def matmat(x):
+        n_vecs = x.shape[1]
+        matmat_out = matmat_outs.get(n_vecs)
+        if matmat_out is None:
+            matmat_out = matmat_outs[n_vecs] = np.empty((n_rows, n_vecs), dtype=wxx.dtype)
+        return np.dot(wxx, x, out=matmat_out)
+
+    wxx_op = aslinearoperator(wxx)
+    wxx_op._matvec = matvec
+    wxx_op._matmat = matmat
+    return wxx_op
+
+
+@njit(cache=True, fastmath=True)
+def _step_kernel(wxx_data, wxx_indices, wxx_indptr, input_drive_t, noise_t,
+                 x_lvl, x_fr, time_div, x_fr_next):
+    """ compiled time step for a tanh nonlinearity. wxx is given as its CSR
+        (data, indices, indptr) triple. updates x_lvl in-place from the firing rates x_fr
+        and writes the new firing rates into x_fr_next, which must not be x_fr """
+
+    # sparse recurrent drive, fused into the activation level update
+    for i in range(x_lvl.size):
+        acc = input_drive_t[i] + noise_t[i]
+        for k in range(wxx_indptr[i], wxx_indptr[i + 1]):
+            acc += wxx_data[k] * x_fr[wxx_indices[k]]
+        x_lvl[i] += (-x_lvl[i] + acc) / time_div
+        x_fr_next[i] = np.tanh(x_lvl[i])
+
+
+@njit(cache=True, fastmath=True, parallel=True)
+def _test_kernel(wxx_data, wxx_indices, wxx_indptr, wxout, input_drive, noise,
+                 x_lvl_init, time_div, x_history, out_history):
+    """ compiled time loop of Trainer.test for a tanh nonlinearity, parallel over trials.
+        noise and the histories are (n_trials, n_steps, n_units), so that each trial
+        reads and writes its own contiguous block """
+
+    n_trials, n_steps, n_units = x_history.shape
+    n_out = wxout.shape[0]
+
+    for trial in prange(n_trials):
+        x_lvl = x_lvl_init[:, trial].copy()
+        x_fr = np.tanh(x_lvl)
+        for t in range(n_steps):
+            _step_kernel(wxx_data, wxx_indices, wxx_indptr, input_drive[t], noise[trial, t],
+                         x_lvl, x_fr, time_div, x_history[trial, t])
+            x_fr = x_history[trial, t]
+
+            for j in range(n_out):
+                acc = 0.
+                for i in range(n_units):
+                    acc += wxout[j, i] * x_fr[i]
+                out_history[trial, t, j] = acc
+
+
 def plot_trial(trainer_obj, x_history, out_history):
     """ given a Trainer object, an array of recurrent unit firing rates,
         and an array of their outputs, plot a trial """
@@ -0,0 +1,106 @@
+""" checks that the alternative code paths of the simulations agree.
+    harvest_innate and test are run with np.tanh and with an equivalent out-taking
+    sigmoid, on sparse and dense recurrent weights, and test also through its
+    parallel tanh kernel. each is compared against a double precision reference
+    of the original algorithm. run with pytest """
+
+import numpy as np
+import pytest
+
+import network as N
+
+SEED = 1234
+N_TRIALS_TEST = 3
+
+
+def tanh_out(x, out=None):
+    """ np.tanh, but not np.tanh itself, so that the numpy loops are used """
+    return np.tanh(x, out=out)
+
+
+def make_trainer(sigmoid, dense):
+    """ a noiseless 500-unit network whose wxx is CSR, or its dense equivalent """
+
+    gen = N.Generator(n_units=500, p_connect=0.1, syn_strength=1.5, p_plastic=0.6)
+    tr = N.Trial(length_ms=300, spacing=2, time_step=1, start_train_ms=150, end_train_ms=300)
+    inp = N.Input(tr, n_units=1, value=5, start_ms=50, duration_ms=50)
+    out = N.Output(tr, n_units=1, value=1, center_ms=250, width_ms=30, baseline_val=0.2)
+    trainer = N.Trainer(gen, inp, out, tr, tau_ms=10, sigmoid=sigmoid,
+                        noise_harvest=0, noise_train=0,
+                        n_trials_recurrent=1, n_trials_readout=1, n_trials_test=N_TRIALS_TEST)
+
+    N.prng = np.random.default_rng(SEED)
+    trainer.initialize_weights()
+    assert N.issparse(gen.wxx_ini)  # the network is sparse enough for CSR
+    if dense:
+        gen.wxx_ini = gen.wxx_ini.toarray()
+
+    # testing uses the initial weights, so that no training is needed
+    gen.wxx_recurr_trained = gen.wxx_ini
+    out.wxout_readout_trained = out.wxout_ini
+    return trainer
+
+
+def reference_simulation(trainer, noise_shape, x_lvl_shape):
+    """ the original float64 simulation from the same initial conditions, which are
+        drawn after the noise. returns (n_trials, n_units, n_steps) firing rates
+        and (n_trials, n_out, n_steps) outputs """
+
+    rng = np.random.default_rng(SEED)
+    rng.standard_normal(noise_shape, dtype=N.float_type)  # zero noise, but it is drawn
+    x_lvl = (2 * rng.random(x_lvl_shape, dtype=N.float_type) - 1).astype(np.float64)
+    x_lvl = x_lvl.reshape(trainer.gen.n_units, -1)
+
+    wxx = trainer.gen.wxx_ini
+    wxx = (wxx.toarray() if N.issparse(wxx) else wxx).astype(np.float64)
+    winputx = trainer.inp.winputx_ini.astype(np.float64)
+    wxout = trainer.out.wxout_ini.astype(np.float64)
+    input_series = trainer.inp.series.astype(np.float64)
+
+    x_history = np.zeros((trainer.tr.n_steps,) + x_lvl.shape)
+    x_fr = np.tanh(x_lvl)
+    for t in range(trainer.tr.n_steps):
+        x_lvl = x_lvl + (-x_lvl + wxx @ x_fr + winputx @ input_series[:, [t]]) / trainer.time_div
+        x_fr = np.tanh(x_lvl)
+        x_history[t] = x_fr
+
+    x_history = x_history.transpose(2, 1, 0)
+    return x_history, wxout @ x_history
+
+
+@pytest.mark.parametrize('dense', [False, True])
+@pytest.mark.parametrize('sigmoid', [np.tanh, tanh_out])
+def test_harvest_innate(sigmoid, dense):
+    trainer = make_trainer(sigmoid, dense)
+    n_steps, n_units = trainer.tr.n_steps, trainer.gen.n_units
+
+    N.prng = np.random.default_rng(SEED)
+    trainer.harvest_innate()
+
+    x_ref, _ = reference_simulation(trainer, (n_steps, n_units), n_units)
+    assert trainer.gen.innate.shape == (n_units, n_steps)
+    np.testing.assert_allclose(trainer.gen.innate, x_ref[0], rtol=0, atol=1e-4)
+
+
+@pytest.mark.parametrize('use_kernel', [False, True])
+@pytest.mark.parametrize('dense', [False, True])
+@pytest.mark.parametrize('sigmoid', [np.tanh, tanh_out])
+def test_test(sigmoid, dense, use_kernel, monkeypatch):
+    trainer = make_trainer(sigmoid, dense)
+    n_steps, n_units = trainer.tr.n_steps, trainer.gen.n_units
+
+    # the parallel kernel is taken with tanh whenever it is allowed a single thread
+    monkeypatch.setattr(N, 'test_kernel_min_threads', 1 if use_kernel else np.inf)
+    trials = []
+    monkeypatch.setattr(N, 'plot_trial', lambda trainer_obj, x_history, out_history:
+                        trials.append((x_history.copy(), out_history.copy())))
+
+    N.prng = np.random.default_rng(SEED)
+    trainer.test()
+
+    x_ref, out_ref = reference_simulation(trainer, (N_TRIALS_TEST, n_steps, n_units),
+                                          (n_units, N_TRIALS_TEST))
+    assert len(trials) == N_TRIALS_TEST
+    for trial, (x_history, out_history) in enumerate(trials):
+        np.testing.assert_allclose(x_history, x_ref[trial], rtol=0, atol=1e-4)
+        np.testing.assert_allclose(out_history, out_ref[trial], rtol=0, atol=1e-4)